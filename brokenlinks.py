@@ -1,34 +1,79 @@
+import contextlib
+import csv
+import hashlib
 import logging
-import os.path
-from typing import Iterator, Set, TextIO
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import (
+    Any,
+    DefaultDict,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    TextIO,
+    Tuple,
+)
 
 import urllib.parse
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import (
     RequestException,
     ReadTimeout,
     ConnectionError as RequestConnectionError,
+    SSLError,
+    Timeout,
 )
-from bs4 import BeautifulSoup
+from lxml import etree
+from urllib3.util import Retry
 
-## TODO: Use multiple threads to speed the processing. This program will mostly
-## be waiting on network IO; this is the classic example for the good use of
-## threads in Python.
+# This program mostly waits on network IO, so links are processed by a pool of
+# worker threads fed from a shared work queue.
 
 START_URLS = ["https://ed.fnal.gov"]
+# Only pages on this host are searched for further links.
+TRAVERSABLE_HOST = "ed.fnal.gov"
+# Set this to logging.DEBUG to trace the processing of every link in debug.log;
+# that is a lot of output, and slows the program down noticeably.
+LOG_LEVEL = logging.INFO
+NUM_WORKERS = min(32, (os.cpu_count() or 1) * 5)
+# Be polite to each server: limit the number of requests in flight to any one
+# host, and the rate at which new requests to it are started.
+MAX_REQUESTS_PER_HOST = 8
+MIN_REQUEST_INTERVAL = 0.1  # seconds
+# After this many consecutive connection failures or timeouts from an external
+# host, links to it are reported as bad without trying to reach it again. The
+# site being searched is never given up on this way.
+DEAD_HOST_FAILURES = 3
+# Pages larger than this (in bytes) are not searched for links, and no more than
+# this much of a page without a declared size is read.
+MAX_PAGE_SIZE = 2_000_000
+# Bytes of output buffered for each output file before it is written out.
+OUTPUT_BUFFER_SIZE = 1 << 16
 GOOD_STATUS_CODES = set([200])
 EXPECTED_SCHEMES = set(["http", "https"])
+DEFAULT_PORTS = {"http": 80, "https": 443}
+# How a normalized URL on the traversable host begins.
+TRAVERSABLE_PREFIXES = tuple(f"{s}://{TRAVERSABLE_HOST}/" for s in EXPECTED_SCHEMES)
 UNHANDLED_SCHEMES = set(["mailto", "javascript"])
 UNTRAVERSABLE_TYPES = set(
-    ["gif", "jpg", "jpeg", "mp4", "mov", "pdf", "ppt", "pptx", "xls", "xlsx"]
+    ["gif", "jpg", "jpeg", "png", "svg", "ico", "mp3", "mp4", "mov", "avi"]
+    + ["pdf", "doc", "ppt", "pptx", "xls", "xlsx", "css", "js", "woff", "woff2"]
 )
-
-
-def is_bad(status: int) -> bool:
-    """Return whether we consider this status to be 'bad' (broken) or not"""
-    group = status // 100
-    return group != 2
+UNTRAVERSABLE_SUFFIXES = tuple(f".{t}" for t in UNTRAVERSABLE_TYPES)
+# Whether links to the untraversable types above are checked at all. Checking
+# costs one request per link; turn it off to check only the searchable pages.
+CHECK_ASSETS = True
 
 
 def is_not_searchable(filepath: str) -> bool:
@@ -36,179 +81,556 @@ def is_not_searchable(filepath: str) -> bool:
     filepath, and False if not.
     """
     # TODO: This file type identification should be made more robust.
-    suffix = filepath.split(".")[-1].lower()
-    return suffix in UNTRAVERSABLE_TYPES
+    return filepath.lower().endswith(UNTRAVERSABLE_SUFFIXES)
 
 
-def should_traverse_url(parsed: urllib.parse.SplitResult) -> bool:
-    """Return True if the URL should be traversed (not merely tested)."""
+def should_traverse_url(url: str, parsed: urllib.parse.SplitResult) -> bool:
+    """Return True if the URL should be traversed (not merely tested); parsed
+    is the URL already split."""
+    if url.startswith(TRAVERSABLE_PREFIXES):
+        # The common case, a normalized link within the site, needs no more
+        # than a string comparison to identify the host.
+        return not is_not_searchable(parsed.path)
     if parsed.scheme not in EXPECTED_SCHEMES:
         # We will not try to traverse, e.g., a 'mailto:','javascript:' links.
         return False
     if is_not_searchable(parsed.path):
         return False
-    return parsed.hostname == "ed.fnal.gov"
+    return parsed.hostname == TRAVERSABLE_HOST
+
+
+def read_html(r: requests.Response) -> Optional[bytes]:
+    """Return the body of a streamed response, or None if it is not an HTML
+    page, or is too large to be worth searching for links."""
+    content_type = r.headers.get("Content-Type", "text/html").lower()
+    if not content_type.startswith(("text/html", "application/xhtml+xml")):
+        return None
+    try:
+        if int(r.headers.get("Content-Length", "0")) > MAX_PAGE_SIZE:
+            return None
+    except ValueError:
+        pass
+    body = bytearray()
+    for chunk in r.iter_content(chunk_size=1 << 16):
+        body += chunk
+        if len(body) >= MAX_PAGE_SIZE:
+            break
+    return bytes(body[:MAX_PAGE_SIZE])
+
+
+class LinkTarget:
+    """An lxml parser target that collects the href of each <a> element, and
+    of the first <base> element, as the HTML is parsed. No document tree is
+    built."""
+
+    def __init__(self) -> None:
+        self.base_href: Optional[str] = None
+        self.hrefs: List[str] = []
+
+    def start(self, tag: str, attrib: Dict[str, str]) -> None:
+        """Called by the parser for each start tag."""
+        href = attrib.get("href")
+        if href is None:
+            return
+        if tag == "a":
+            self.hrefs.append(href.strip())
+        elif tag == "base" and self.base_href is None:
+            self.base_href = href.strip()
+
+    def close(self) -> List[str]:
+        """Called by the parser at the end of the document."""
+        return self.hrefs
 
 
 def parse_links(
-    current_page: urllib.parse.SplitResult, current_html: BeautifulSoup
-) -> Iterator[str]:
-    """Parse the given HTML text, yielding each link found."""
-    for anchor in current_html.find_all("a", href=True):
-        new_url = anchor.get("href")
-        msg = "parse_links processing href %s"
-        logging.debug(msg, new_url)
-        full_url = fixup_url(
-            current_page.scheme, current_page.netloc, current_page.path, new_url
-        )
-        yield full_url
+    current_page: urllib.parse.SplitResult, content: bytes
+) -> Iterator[urllib.parse.SplitResult]:
+    """Parse the given HTML text, yielding each link found, already split."""
+    target = LinkTarget()
+    try:
+        etree.fromstring(content, etree.HTMLParser(target=target))
+    except etree.LxmlError:
+        # A hopelessly malformed page has no links for us to follow.
+        return
+    # Relative links are relative to the <base href>, if there is one.
+    base = current_page.geturl()
+    if target.base_href:
+        try:
+            base = urllib.parse.urljoin(base, target.base_href)
+        except ValueError:
+            pass
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    for new_url in target.hrefs:
+        if debug:
+            msg = "parse_links processing href %s"
+            logging.debug(msg, new_url)
+        try:
+            yield fixup_url(base, new_url)
+        except ValueError:
+            # Drop any link that can not be made absolute.
+            continue
 
 
-def fixup_url(scheme: str, server: str, page_path: str, new_url: str) -> str:
-    """Fixup a URL, returning a complete and absolute URL to the same resource."""
-    split_url = urllib.parse.urlsplit(new_url)
+def fixup_url(base_url: str, new_url: str) -> urllib.parse.SplitResult:
+    """Fixup a URL found on the page at base_url, returning a complete and
+    absolute URL to the same resource, already split."""
+    # urljoin follows the same rules as a web browser for relative links.
+    # See: https://stackoverflow.com/questions/2005079/absolute-vs-relative-urls
+    return normalize_url(urllib.parse.urlsplit(urllib.parse.urljoin(base_url, new_url)))
 
-    if split_url.scheme.lower() == "mailto":
-        return new_url
 
-    # Canonicalize the parts.
+def normalize_url(split_url: urllib.parse.SplitResult) -> urllib.parse.SplitResult:
+    """Return the given absolute URL with its scheme and server lowercased, and
+    without any fragment."""
+    # We don't do anything more to, e.g., mailto links.
     normalized_scheme = split_url.scheme.lower()
-    normalized_netloc = split_url.netloc.lower()
-    normalized_path = "/".join(
-        segment.strip("/") for segment in split_url.path.split("/")
+    if normalized_scheme not in EXPECTED_SCHEMES:
+        return split_url
+
+    # Canonicalize the parts. The fragment is never sent to the server, but the
+    # query is kept so that the link is fetched and reported as written.
+    return urllib.parse.SplitResult(
+        normalized_scheme,
+        split_url.netloc.lower(),
+        split_url.path or "/",
+        split_url.query,
+        "",
     )
 
-    # We don't do anything more to mailto links.
 
-    # Try to duplicate the rules followed by the combination of a web browser
-    # and web server.
-    # See: https://stackoverflow.com/questions/2005079/absolute-vs-relative-urls
-    if normalized_scheme == "":
-        normalized_scheme = scheme
-    if normalized_scheme in ("https", "http"):
-        if normalized_netloc == "":
-            normalized_netloc = server
-        if normalized_path == "":
-            normalized_path = "/"
-        if not normalized_path.startswith("/"):
-            normalized_path = complete_relative_link(normalized_path, page_path)
-
-    return f"{normalized_scheme}://{normalized_netloc}{normalized_path}"
+def canonicalize(parsed: urllib.parse.SplitResult) -> str:
+    """Return the canonical form of a URL, which is the same for URLs that
+    differ only in ways that do not name a different resource: the case of
+    the scheme and host, an explicit default port, a trailing "/", the query
+    and the fragment."""
+    scheme = parsed.scheme.lower()
+    if scheme not in EXPECTED_SCHEMES:
+        return parsed.geturl()
+    try:
+        port = parsed.port
+    except ValueError:
+        # Leave a URL with an invalid port alone; it will be reported as bad.
+        return parsed.geturl()
+    netloc = parsed.hostname or ""
+    if ":" in netloc:
+        netloc = f"[{netloc}]"
+    if port is not None and port != DEFAULT_PORTS[scheme]:
+        netloc += f":{port}"
+    path = parsed.path.rstrip("/") or "/"
+    return urllib.parse.urlunsplit((scheme, netloc, path, "", ""))
+
+
+def url_digest(url: str) -> int:
+    """Return a 64-bit digest of the given URL. Collisions are vanishingly
+    unlikely for any number of URLs a crawl will see."""
+    return int.from_bytes(
+        hashlib.blake2b(url.encode("utf-8"), digest_size=8).digest(), "big"
+    )
 
 
-def complete_relative_link(relative_link: str, page_path: str) -> str:
-    """Complete the given relative link by adding the current directory from
-    the current page."""
-    current_directory = os.path.dirname(page_path)
-    new_path = os.path.join(current_directory, relative_link)
-    return new_path
+def page_fingerprint(parsed_url: urllib.parse.SplitResult, content: bytes) -> int:
+    """Return a 64-bit digest of the parts of a page that determine the links
+    found on it: the directory against which its relative links are resolved,
+    and its whole content. Pages with the same fingerprint have the same
+    links."""
+    directory = parsed_url.path.rpartition("/")[0]
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(f"{parsed_url.scheme}://{parsed_url.netloc}{directory}/".encode())
+    digest.update(content)
+    return int.from_bytes(digest.digest(), "big")
 
 
 class BrokenLinkCollector:
     """Main application object."""
 
     def __init__(
-        self, results: TextIO, redirects: TextIO, visited: TextIO, unhandled: TextIO
+        self,
+        results: TextIO,
+        redirects: TextIO,
+        visited: TextIO,
+        unhandled: TextIO,
+        check_assets: bool = CHECK_ASSETS,
     ):
-        self.seen_urls: Set[str] = set()
-        self.results = results
-        self.redirects = redirects
-        self.visited = visited
-        self.unhandled = unhandled
+        # Only a digest of each canonical URL is kept, not the URL itself.
+        self.seen_urls: Set[int] = set()
+        self.seen_pages: Set[int] = set()
+        # Exact (not canonical) digests of the URLs on either side of a
+        # redirect to an equivalent URL, such as /foo to /foo/.
+        self.seen_redirect_urls: Set[int] = set()
+        self.seen_lock = threading.Lock()
+        # Rows for the output files are queued for a single writer thread, so
+        # the workers never contend for the files.
+        self.output_rows: (
+            "queue.SimpleQueue[Optional[Tuple[Any, Sequence[object]]]]"
+        ) = queue.SimpleQueue()
+        # Each work item is a (page, url) pair, with the url already split, so
+        # that no URL is parsed more than once; None tells a worker to stop.
+        self.work: "queue.Queue[Optional[Tuple[str, urllib.parse.SplitResult]]]" = (
+            queue.Queue()
+        )
+        # Rows are written as they are found, rather than collected in memory;
+        # the csv module takes care of quoting URLs that contain commas.
+        self.results = csv.writer(results, lineterminator="\n")
+        self.redirects = csv.writer(redirects, lineterminator="\n")
+        self.visited = csv.writer(visited, lineterminator="\n")
+        self.unhandled = csv.writer(unhandled, lineterminator="\n")
+        self.check_assets = check_assets
+        # Checked once here, so that the per-link debug messages cost nothing
+        # when they are not wanted.
+        self.debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        self.host_lock = threading.Lock()
+        self.host_slots: DefaultDict[str, threading.BoundedSemaphore] = defaultdict(
+            lambda: threading.BoundedSemaphore(MAX_REQUESTS_PER_HOST)
+        )
+        self.host_next_start: Dict[str, float] = {}
+        self.host_failures: Dict[str, int] = {}
+        # A single session lets all the workers share pooled keep-alive
+        # connections, rather than making a new connection for each request.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=32,
+            pool_maxsize=64,
+            # Retry only failures to connect or read. A 429 or 503 is reported
+            # as it is, rather than holding a worker and a host slot for as
+            # long as the server's Retry-After asks.
+            max_retries=Retry(
+                total=2, backoff_factor=0.2, status=0, respect_retry_after_header=False
+            ),
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
         self.write_headers()
 
+    def __enter__(self) -> "BrokenLinkCollector":
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Release the pooled network connections."""
+        self.session.close()
+
     def write_headers(self) -> None:
         """Write the headers for all output files."""
-        self.results.write("host_page,broken_url,status\n")
-        self.redirects.write("host_page,redirected_url,stauts\n")
-        self.visited.write("url\n")
-        self.unhandled.write("page,url\n")
+        self.results.writerow(["host_page", "broken_url", "status"])
+        self.redirects.writerow(["host_page", "redirected_url", "location", "status"])
+        self.visited.writerow(["url"])
+        self.unhandled.writerow(["page", "url"])
+
+    def write(self, output: Any, row: Sequence[object]) -> None:
+        """Write a row to one of the output files; safe to call from any worker.
+        The row is written by the writer thread during a crawl."""
+        self.output_rows.put((output, row))
+
+    def writer(self) -> None:
+        """Write queued rows to the output files until told to stop."""
+        while True:
+            item = self.output_rows.get()
+            if item is None:
+                return
+            output, row = item
+            output.writerow(row)
+
+    @contextlib.contextmanager
+    def throttle(self, host: str) -> Iterator[None]:
+        """Wait for permission to make a request to the given host, holding one
+        of its request slots for the duration of the with block."""
+        with self.host_lock:
+            slots = self.host_slots[host]
+        with slots:
+            # Reserve the next start time for this host, then wait for it
+            # outside the lock so other hosts are not held up.
+            with self.host_lock:
+                now = time.monotonic()
+                start = max(now, self.host_next_start.get(host, now))
+                self.host_next_start[host] = start + MIN_REQUEST_INTERVAL
+            time.sleep(start - now)
+            yield
+
+    def enqueue(self, page: str, parsed_url: urllib.parse.SplitResult) -> None:
+        """Put the given (split) URL, found on page, on the work queue, unless it
+        has been seen before. The queue thus only ever holds new URLs."""
+        if not self.check_assets and is_not_searchable(parsed_url.path):
+            # Skip the request entirely for links to images, documents, etc.
+            if self.debug:
+                msg = "Not checking link %s to an untraversable type"
+                logging.debug(msg, parsed_url.geturl())
+            return
 
-    def process(self, page_full_url: str, full_url: str) -> None:
-        """Process the given URL, and all the (internal) pages to which it links, recursively."""
         # Only process each URL once, regardless of how many times we see it.
-        msg = "Starting to process link %s on page %s"
-        logging.debug(msg, full_url, page_full_url)
-
-        if full_url in self.seen_urls:
-            msg = "We have already seen link %s, will not process it again"
-            logging.debug(msg, full_url)
+        # The canonical form is used only to recognize duplicates; the URL as
+        # written, less any fragment, is what we fetch and report.
+        key = url_digest(canonicalize(parsed_url))
+        with self.seen_lock:
+            if key in self.seen_urls:
+                if self.debug:
+                    msg = "We have already seen link %s, will not process it again"
+                    logging.debug(msg, parsed_url.geturl())
+                return
+            self.seen_urls.add(key)
+        if self.debug:
+            msg = "Registering link %s as seen"
+            logging.debug(msg, parsed_url.geturl())
+        self.work.put((page, parsed_url))
+
+    def enqueue_redirect_target(
+        self,
+        page: str,
+        parsed_url: urllib.parse.SplitResult,
+        target: urllib.parse.SplitResult,
+    ) -> None:
+        """Put the target of a redirect from parsed_url on the work queue, unless
+        it has been seen before."""
+        if canonicalize(target) != canonicalize(parsed_url):
+            self.enqueue(page, target)
             return
-
-        msg = "Registering link %s as seen"
-        logging.debug(msg, full_url)
-        self.seen_urls.add(full_url)
-        self.visited.write(f"{full_url}\n")
-        parsed_url = urllib.parse.urlsplit(full_url)
+        if target.geturl() == parsed_url.geturl():
+            # Normalizing the target gave back the redirecting URL itself
+            # (e.g. /login for /login#form), which has already been checked.
+            return
+        # The target (e.g. /foo/ for /foo) has the same canonical form as the
+        # redirecting URL, so the seen-URL check would drop it. Queue it
+        # anyway, but only once for each exact URL, so that redirect loops
+        # still end.
+        source_key = url_digest(parsed_url.geturl())
+        target_key = url_digest(target.geturl())
+        with self.seen_lock:
+            if target_key in self.seen_redirect_urls:
+                return
+            self.seen_redirect_urls.update((source_key, target_key))
+        self.work.put((page, target))
+
+    def crawl(self, start_urls: Iterable[str], num_workers: int = NUM_WORKERS) -> None:
+        """Process each of the given URLs, and all the (internal) pages to which
+        they link, using a pool of worker threads. Returns when all the links
+        have been processed."""
+        for url in start_urls:
+            self.enqueue(url, urllib.parse.urlsplit(url))
+        with ThreadPoolExecutor(max_workers=num_workers + 1) as executor:
+            writer = executor.submit(self.writer)
+            workers = [executor.submit(self.worker) for _ in range(num_workers)]
+            try:
+                self.work.join()
+            finally:
+                # If we were interrupted (e.g. by Ctrl-C), throw away the
+                # outstanding work, so that each worker stops after its current
+                # link. Always tell the workers and then the writer to stop, or
+                # leaving the executor would wait for them forever.
+                try:
+                    self.discard_work()
+                    for _ in workers:
+                        self.work.put(None)
+                    wait(workers)
+                finally:
+                    self.output_rows.put(None)
+        for w in [writer] + workers:
+            # Re-raise anything that escaped a worker or the writer.
+            w.result()
+
+    def discard_work(self) -> None:
+        """Remove all the items waiting on the work queue."""
+        while True:
+            try:
+                self.work.get_nowait()
+            except queue.Empty:
+                return
+            self.work.task_done()
+
+    def worker(self) -> None:
+        """Process (page, url) pairs from the work queue until told to stop."""
+        while True:
+            item = self.work.get()
+            if item is None:
+                self.work.task_done()
+                return
+            page, parsed_url = item
+            try:
+                self.process(page, parsed_url)
+            except Exception:  # pylint: disable=broad-except
+                # Keep the worker alive, so that the queue is always drained.
+                msg = "Unexpected error processing link %s on page %s"
+                logging.exception(msg, parsed_url.geturl(), page)
+            finally:
+                self.work.task_done()
+
+    def process(self, page_full_url: str, parsed_url: urllib.parse.SplitResult) -> None:
+        """Process the given (split) URL, which has not been seen before. New
+        links found on (internal) pages are put on the work queue, to be
+        processed in turn."""
+        full_url = parsed_url.geturl()
+        if self.debug:
+            msg = "Starting to process link %s on page %s"
+            logging.debug(msg, full_url, page_full_url)
+        self.write(self.visited, [full_url])
         if parsed_url.scheme.lower() in UNHANDLED_SCHEMES:
-            self.unhandled.write(f"{page_full_url},{full_url}\n")
+            self.write(self.unhandled, [page_full_url, full_url])
             return
-        if should_traverse_url(parsed_url):
-            self.process_traversable_url(page_full_url, full_url)
+        if should_traverse_url(full_url, parsed_url):
+            self.process_traversable_url(page_full_url, full_url, parsed_url)
             return
-        self.process_external_url(page_full_url, full_url)
+        self.process_external_url(page_full_url, full_url, parsed_url)
 
-    def process_external_url(self, page: str, url: str) -> None:
+    def process_external_url(
+        self, page: str, url: str, parsed_url: urllib.parse.SplitResult
+    ) -> None:
         """Process a URL that we are not intended to search for links."""
-        msg = "Will not traverse link %s; starting test for access"
-        logging.debug(msg, url)
+        if self.debug:
+            msg = "Will not traverse link %s; starting test for access"
+            logging.debug(msg, url)
+        host = parsed_url.hostname or ""
+        track_failures = host != TRAVERSABLE_HOST
+        with self.host_lock:
+            dead = self.host_failures.get(host, 0) >= DEAD_HOST_FAILURES
+        if track_failures and dead:
+            if self.debug:
+                msg = "Host of %s is not responding; not trying to reach it"
+                logging.debug(msg, url)
+            self.write(self.results, [page, url, 999])
+            return
         try:
-            r = requests.head(url, timeout=1.0)
-            msg = "Status for %s is %d"
-            logging.debug(msg, url, r.status_code)
-            if is_bad(r.status_code):
-                self.write_bad_link(page, r, url)
-        except (RequestException, ReadTimeout, RequestConnectionError):
+            with self.throttle(host):
+                r = self.session.head(url, timeout=1.0, allow_redirects=False)
+        except (RequestException, ReadTimeout, RequestConnectionError) as e:
             # We are using status code = 999 to represent any error that
             # caused the server to not return a result. More specificity
-            # is possible, if desired.
-            self.results.write(f"{page},{url},999\n")
+            # is possible, if desired. Only a server that could not be
+            # reached counts towards giving up on it; a bad URL or
+            # certificate says nothing about the server's other links.
+            unreachable = isinstance(e, (RequestConnectionError, Timeout))
+            if track_failures and unreachable and not isinstance(e, SSLError):
+                with self.host_lock:
+                    self.host_failures[host] = self.host_failures.get(host, 0) + 1
+            self.write(self.results, [page, url, 999])
+            return
+        if track_failures:
+            with self.host_lock:
+                self.host_failures[host] = 0
+        if self.debug:
+            msg = "Status for %s is %d"
+            logging.debug(msg, url, r.status_code)
+        # Any status other than success (2xx) is 'bad' (broken).
+        if not 200 <= r.status_code < 300:
+            self.write_bad_link(page, r, url, parsed_url)
 
-    def process_traversable_url(self, page: str, url: str) -> None:
+    def process_traversable_url(
+        self, page: str, url: str, parsed_url: urllib.parse.SplitResult
+    ) -> None:
         """Process a URL that we are intended to search for links.
-        Both page and url are full URLs (with scheme, server, and path)."""
-        msg = "Trying to get traversable url %s"
-        logging.debug(msg, url)
+        Both page and url are full URLs (with scheme, server, and path), and
+        parsed_url is url already split."""
+        if self.debug:
+            msg = "Trying to get traversable url %s"
+            logging.debug(msg, url)
 
         try:
-            r = requests.get(url, timeout=2.0)
-            msg = "Status for %s is %d"
-            logging.debug(msg, url, r.status_code)
-            if is_bad(r.status_code):
-                self.write_bad_link(page, r, url)
-            else:
-                soup = BeautifulSoup(r.content, features="lxml")
-                current_page_split = urllib.parse.urlsplit(page)
-                for new_link in parse_links(current_page_split, soup):
-                    # new_link will be a full URL.
-                    # Recursively process the new link, recording it as contents of the current URL.
-                    self.process(url, new_link)
+            # Stream the response, so that we never download more of it than
+            # we are going to search.
+            with self.throttle(parsed_url.hostname or ""), self.session.get(
+                url, timeout=2.0, allow_redirects=False, stream=True
+            ) as r:
+                if self.debug:
+                    msg = "Status for %s is %d"
+                    logging.debug(msg, url, r.status_code)
+                if not 200 <= r.status_code < 300:
+                    self.write_bad_link(page, r, url, parsed_url)
+                    return
+                content = read_html(r)
         except (RequestException, ReadTimeout, ConnectionError):
-            self.results.write(f"{page},{url},999\n")
-
-    def write_bad_link(self, page: str, r: requests.Response, url: str) -> None:
-        group = r.status_code // 100
-        if group == 3:
-            self.redirects.write(f"{page},{url},{r.status_code}\n")
+            self.write(self.results, [page, url, 999])
+            return
+        if content is None:
+            if self.debug:
+                msg = "Not searching %s, which is not an HTML page of reasonable size"
+                logging.debug(msg, url)
+            return
+        # A page identical to one already searched (e.g. the same page under
+        # another URL) need not be parsed again.
+        fingerprint = page_fingerprint(parsed_url, content)
+        with self.seen_lock:
+            if fingerprint in self.seen_pages:
+                if self.debug:
+                    msg = "Not searching %s, which is the same as another page"
+                    logging.debug(msg, url)
+                return
+            self.seen_pages.add(fingerprint)
+        for new_link in parse_links(parsed_url, content):
+            # new_link will be a full (split) URL.
+            # Queue the new link, recording it as contents of the current URL.
+            self.enqueue(url, new_link)
+
+    def write_bad_link(
+        self,
+        page: str,
+        r: requests.Response,
+        url: str,
+        parsed_url: urllib.parse.SplitResult,
+    ) -> None:
+        if 300 <= r.status_code < 400:
+            location = r.headers.get("Location", "")
+            self.write(self.redirects, [page, url, location, r.status_code])
+            if location:
+                # Redirects are never followed by requests, so queue the
+                # target to be checked (once) as if it were linked from page.
+                try:
+                    target = fixup_url(url, location)
+                except ValueError:
+                    # The location can not be made absolute, so can not be checked.
+                    return
+                self.enqueue_redirect_target(page, parsed_url, target)
         else:
-            self.results.write(f"{page},{url},{r.status_code}\n")
+            self.write(self.results, [page, url, r.status_code])
 
 
 if __name__ == "__main__":
-    logging.basicConfig(filename="debug.log", encoding="utf-8", level=logging.DEBUG)
-    with open("results.csv", mode="w", encoding="utf-8") as results, open(
-        "visited_links.txt", mode="w", encoding="utf-8"
-    ) as visited_links, open(
-        "unhandled_links.txt", mode="w", encoding="utf-8"
-    ) as unhandled_links, open(
-        "redirects.csv", mode="w", encoding="utf-8"
-    ) as redirects:
-        app = BrokenLinkCollector(results, redirects, visited_links, unhandled_links)
-        for item in START_URLS:
+    # Log records are handed to a background thread to be formatted and
+    # written, so the workers never wait on the log file.
+    logging.raiseExceptions = False
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    log_listener = logging.handlers.QueueListener(
+        log_queue, logging.FileHandler("debug.log", encoding="utf-8")
+    )
+    logging.basicConfig(
+        level=LOG_LEVEL, handlers=[logging.handlers.QueueHandler(log_queue)]
+    )
+    log_listener.start()
+    try:
+        with open(
+            "results.csv",
+            mode="w",
+            encoding="utf-8",
+            newline="",
+            buffering=OUTPUT_BUFFER_SIZE,
+        ) as results, open(
+            "visited_links.txt",
+            mode="w",
+            encoding="utf-8",
+            newline="",
+            buffering=OUTPUT_BUFFER_SIZE,
+        ) as visited_links, open(
+            "unhandled_links.txt",
+            mode="w",
+            encoding="utf-8",
+            newline="",
+            buffering=OUTPUT_BUFFER_SIZE,
+        ) as unhandled_links, open(
+            "redirects.csv",
+            mode="w",
+            encoding="utf-8",
+            newline="",
+            buffering=OUTPUT_BUFFER_SIZE,
+        ) as redirects, BrokenLinkCollector(
+            results,
+            redirects,
+            visited_links,
+            unhandled_links,
+            check_assets=CHECK_ASSETS,
+        ) as app:
             msg = "Start processing %s"
-            logging.debug(msg, item)
-            app.process(item, item)
-            msg = "Finished processing %s"
-            logging.debug(msg, item)
+            logging.info(msg, START_URLS)
+            app.crawl(START_URLS)
 
-    logging.debug("Finished processing all top-level URLs.")
+        logging.info("Finished processing all top-level URLs.")
+    finally:
+        # Write out any records still queued, even if the crawl failed.
+        log_listener.stop()